@@ -1,10 +1,15 @@
 from flask import Flask
 
+from booking.loader import preload
+
 from . import config as _config
+from .db import get_db, init_db
 from .routes.voice import voice_bp
 
 
 def create_app():
     app = Flask(__name__)
+    init_db(get_db())
+    preload(_config.BOOKING_CSV_PATH)
     app.register_blueprint(voice_bp)
     return app
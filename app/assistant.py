@@ -1,43 +1,138 @@
 import os
 import re
 import sqlite3
+import time
 
-from openai import OpenAI, OpenAIError
+from openai import OpenAIError
 
 from booking.context import build_booking_context
+from booking.embeddings import OPENAI_TIMEOUT, cached_query_embedding, get_client
 
 from .config import (
-    AVAILABILITY_KEYWORDS,
+    AVAILABILITY_RE,
     BOOKING_CSV_PATH,
     BOOKING_DB_PATH,
     BOOKING_TOP_K,
-    DATE_RE,
+    HISTORY_LIMIT,
     MODEL,
+    SUMMARY_BATCH,
+    SUMMARY_MODEL,
+    SUMMARY_PROMPT,
     SYSTEM_PROMPT,
+    TURN_TIMEOUT,
 )
-from .db import load_messages, save_message
+from .call_state import (
+    get_conversation_summary,
+    get_current_call_sid,
+    set_conversation_summary,
+)
+from .db import get_db, load_messages, load_overflow_messages, save_messages
+from .semantic_cache import context_hash, lookup_reply, store_reply
+
+_SENTENCE_END_RE = re.compile(r"[.!?]\s+")
 
 
 def should_use_booking_context(user_text):
-    if not user_text:
-        return False
-    text = user_text.lower()
-    tokens = set(re.findall(r"[a-z0-9]+", text))
-    if tokens & AVAILABILITY_KEYWORDS:
-        return True
-    return DATE_RE.search(text) is not None
+    return bool(user_text) and AVAILABILITY_RE.search(user_text) is not None
+
+
+def refresh_conversation_summary(client):
+    summary, summary_upto = get_conversation_summary()
+    overflow = load_overflow_messages(summary_upto, HISTORY_LIMIT)
+    if len(overflow) < SUMMARY_BATCH:
+        return summary, summary_upto
+    messages = [{"role": "system", "content": SUMMARY_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": "Summary so far: " + summary})
+    messages.append(
+        {
+            "role": "user",
+            "content": "\n".join(
+                "{role}: {content}".format(**message) for message in overflow
+            ),
+        }
+    )
+    try:
+        completion = client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=messages,
+            temperature=0,
+        )
+    except OpenAIError:
+        # The summary only trims the prompt; keep the previous one and let a
+        # later turn fold these messages in.
+        return summary, summary_upto
+    summary = (completion.choices[0].message.content or "").strip() or summary
+    summary_upto = overflow[-1]["id"]
+    set_conversation_summary(summary, summary_upto)
+    return summary, summary_upto
+
+
+def _bounded_client(client, deadline):
+    # Never wait past the turn's deadline, whatever earlier calls used up.
+    timeout = min(OPENAI_TIMEOUT, deadline - time.monotonic())
+    return client.with_options(timeout=max(timeout, 1.0))
 
 
-def generate_reply(user_text, save_user=True):
+def _stream_completion(client, messages, on_sentence):
+    # Hand each completed sentence to on_sentence as soon as it arrives; the
+    # unfinished tail is left for the caller to pick up from the return value.
+    parts = []
+    buffer = ""
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        temperature=0,
+        stream=True,
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        parts.append(delta)
+        buffer += delta
+        end = 0
+        for match in _SENTENCE_END_RE.finditer(buffer):
+            end = match.end()
+        if end:
+            on_sentence(buffer[:end])
+            buffer = buffer[end:]
+    return "".join(parts)
+
+
+def generate_reply(user_text, save_user=True, on_sentence=None):
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         return "The assistant is not configured right now. Please try again later."
 
+    # Messages from this turn are written together once the reply is known.
+    pending = []
+    if save_user and user_text:
+        pending.append(("user", user_text))
+
+    deadline = time.monotonic() + TURN_TIMEOUT
     try:
-        client = OpenAI(api_key=api_key)
-        if save_user and user_text:
-            save_message("user", user_text)
+        client = get_client()
+        # Keep the static prompt, the summary and the history at the front so
+        # the provider's automatic prefix cache can reuse them across turns;
+        # the per-turn booking context goes just before the latest message.
         messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        # Older turns are folded into a running summary SUMMARY_BATCH messages
+        # at a time, and everything after it is sent verbatim. The history
+        # therefore only grows between summaries (up to HISTORY_LIMIT +
+        # SUMMARY_BATCH - 1 messages) instead of sliding every turn, which
+        # would change the prefix each time.
+        summary, summary_upto = refresh_conversation_summary(
+            _bounded_client(client, deadline)
+        )
+        if summary:
+            messages.append(
+                {"role": "system", "content": "Earlier in this call: " + summary}
+            )
+        messages.extend(load_messages(after_id=summary_upto))
+        if pending:
+            messages.append({"role": "user", "content": user_text})
+        booking_context = ""
         if should_use_booking_context(user_text):
             booking_context = build_booking_context(
                 user_text,
@@ -46,16 +141,50 @@ def generate_reply(user_text, save_user=True):
                 db_path=BOOKING_DB_PATH,
             )
             if booking_context:
-                messages.append({"role": "system", "content": booking_context})
-        messages.extend(load_messages())
-        completion = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0,
-        )
-        reply = completion.choices[0].message.content.strip()
+                messages.insert(
+                    max(1, len(messages) - 1),
+                    {"role": "system", "content": booking_context},
+                )
+        # Only availability answers are cached: they are grounded in the
+        # booking context, so a near-duplicate question against the same
+        # context in the same call can safely reuse the earlier reply. The cache reuses the
+        # embedding booking search already computed for this question; turns
+        # answered without one (dated or narrow queries) skip it rather than
+        # pay for an extra round trip. A cache failure never costs the answer.
+        query_embedding = None
+        if booking_context:
+            context_key = context_hash(booking_context)
+            call_sid = get_current_call_sid(get_db()) or ""
+            query_embedding = cached_query_embedding(user_text, db_path=BOOKING_DB_PATH)
+        if query_embedding is not None:
+            try:
+                cached_reply = lookup_reply(query_embedding, context_key, call_sid)
+            except sqlite3.Error:
+                cached_reply = None
+            if cached_reply:
+                pending.append(("assistant", cached_reply))
+                save_messages(pending)
+                return cached_reply
+        if on_sentence is not None:
+            reply = _stream_completion(
+                _bounded_client(client, deadline), messages, on_sentence
+            ).strip()
+        else:
+            completion = _bounded_client(client, deadline).chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=0,
+            )
+            reply = completion.choices[0].message.content.strip()
         if reply:
-            save_message("assistant", reply)
+            pending.append(("assistant", reply))
+            if query_embedding is not None:
+                try:
+                    store_reply(query_embedding, context_key, call_sid, reply)
+                except sqlite3.Error:
+                    pass
+        if pending:
+            save_messages(pending)
         return reply or "Sorry, I don't have a response right now."
     except (OpenAIError, sqlite3.Error):
         return "Sorry, I'm having trouble right now. Please try again."
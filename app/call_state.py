@@ -1,12 +1,33 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from .db import (
-    delete_meta,
     get_db,
     get_meta,
-    init_db,
     reset_conversation,
     set_meta,
 )
 
+# Hand-offs between /voice/respond and /voice/answer for the same call live
+# in process memory; an entry lost to a restart just means the caller is
+# asked to repeat. Entries older than the TTL belong to abandoned calls.
+_PENDING_TTL_SECONDS = 60
+_reply_executor = ThreadPoolExecutor(max_workers=4)
+_pending_user_text = {}
+_pending_replies = {}
+_pending_lock = threading.Lock()
+
+
+def _expire_pending(entries, now):
+    expired = [
+        key
+        for key, (created, _) in entries.items()
+        if now - created > _PENDING_TTL_SECONDS
+    ]
+    for key in expired:
+        del entries[key]
+
 
 def get_current_call_sid(conn):
     return get_meta(conn, "call_sid")
@@ -20,31 +41,89 @@ def ensure_call_context(call_sid):
     if not call_sid:
         return
     conn = get_db()
-    try:
-        init_db(conn)
-        current_call_sid = get_current_call_sid(conn)
-        if current_call_sid != call_sid:
-            reset_conversation(conn)
-            set_current_call_sid(conn, call_sid)
-    finally:
-        conn.close()
+    current_call_sid = get_current_call_sid(conn)
+    if current_call_sid != call_sid:
+        reset_conversation(conn)
+        set_current_call_sid(conn, call_sid)
+
 
+def set_pending_user_text(call_sid, content):
+    with _pending_lock:
+        _pending_user_text[call_sid] = (time.monotonic(), content)
 
-def set_pending_user_text(content):
+
+def pop_pending_user_text(call_sid):
+    with _pending_lock:
+        _expire_pending(_pending_user_text, time.monotonic())
+        entry = _pending_user_text.pop(call_sid, None)
+    return entry[1] if entry else ""
+
+
+def get_conversation_summary():
     conn = get_db()
-    try:
-        init_db(conn)
-        set_meta(conn, "pending_user_text", content)
-    finally:
-        conn.close()
+    summary = get_meta(conn, "conversation_summary") or ""
+    summary_upto = int(get_meta(conn, "summary_upto") or 0)
+    return summary, summary_upto
 
 
-def pop_pending_user_text():
+def set_conversation_summary(summary, summary_upto):
     conn = get_db()
-    try:
-        init_db(conn)
-        value = get_meta(conn, "pending_user_text")
-        delete_meta(conn, "pending_user_text")
-    finally:
-        conn.close()
-    return value or ""
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [("conversation_summary", summary), ("summary_upto", str(summary_upto))],
+        )
+
+
+def start_pending_reply(call_sid, fn, *args):
+    entry = {"chunks": [], "spoken": 0, "condition": threading.Condition()}
+
+    def on_sentence(sentence):
+        with entry["condition"]:
+            entry["chunks"].append(sentence)
+            entry["condition"].notify_all()
+
+    def on_done(_future):
+        with entry["condition"]:
+            entry["condition"].notify_all()
+
+    entry["future"] = _reply_executor.submit(fn, *args, on_sentence=on_sentence)
+    entry["future"].add_done_callback(on_done)
+    with _pending_lock:
+        _expire_pending(_pending_replies, time.monotonic())
+        _pending_replies[call_sid] = (time.monotonic(), entry)
+    return entry["future"]
+
+
+def wait_pending_reply(call_sid, timeout):
+    """Wait for streamed sentences or the finished reply.
+
+    Returns (texts, finished): while generation is still running, texts are
+    the sentences streamed since the last call; once it has finished, texts
+    hold whatever part of the reply has not been handed out yet.
+    """
+    with _pending_lock:
+        entry = _pending_replies.get(call_sid)
+    if entry is None:
+        return None
+    entry = entry[1]
+    future = entry["future"]
+    with entry["condition"]:
+        entry["condition"].wait_for(
+            lambda: len(entry["chunks"]) > entry["spoken"] or future.done(),
+            timeout,
+        )
+        if not future.done():
+            texts = entry["chunks"][entry["spoken"] :]
+            entry["spoken"] = len(entry["chunks"])
+            return texts, False
+        spoken = "".join(entry["chunks"][: entry["spoken"]]).strip()
+    reply = future.result()
+    if spoken and reply.startswith(spoken):
+        reply = reply[len(spoken) :].strip()
+    return ([reply] if reply else []), True
+
+
+def clear_pending_reply(call_sid):
+    with _pending_lock:
+        _pending_replies.pop(call_sid, None)
@@ -16,7 +16,29 @@ try:
     BOOKING_TOP_K = int(os.environ.get("BOOKING_TOP_K", "10"))
 except ValueError:
     BOOKING_TOP_K = 10
+try:
+    SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+except ValueError:
+    SEMANTIC_CACHE_THRESHOLD = 0.93
+try:
+    SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "500"))
+except ValueError:
+    SEMANTIC_CACHE_SIZE = 500
 MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+# Summaries run inside the caller's turn, so they use a small, cheap model
+# regardless of OPENAI_MODEL.
+SUMMARY_MODEL = os.environ.get("OPENAI_SUMMARY_MODEL", "gpt-4o-mini")
+try:
+    HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", "20"))
+except ValueError:
+    HISTORY_LIMIT = 20
+SUMMARY_BATCH = 10
+# Every model call in one turn shares this budget, keeping the whole turn
+# inside Twilio's 15 second webhook timeout.
+try:
+    TURN_TIMEOUT = float(os.environ.get("OPENAI_TURN_TIMEOUT", "12"))
+except ValueError:
+    TURN_TIMEOUT = 12.0
 SYSTEM_PROMPT = (
     "You are a helpful phone call assistant for a motel. Keep responses concise, natural, "
     "the main goal is to guide for hotel bookings over the phone and any special requests. "
@@ -30,6 +52,50 @@ SYSTEM_PROMPT = (
     "If information is missing or unclear, ask a brief follow-up or say you do not have it. "
     "Do not generate super long sentences, and response is suitable for being read aloud."
 )
+SUMMARY_PROMPT = (
+    "Summarize the earlier part of this motel phone call in a few short sentences. "
+    "Keep the caller's name, dates, room preferences, special requests, and anything "
+    "the assistant promised. Do not add details that are not in the transcript."
+)
+END_CALL_PHRASES = (
+    "thanks for your time",
+    "thank you for your time",
+    "goodbye",
+    "good bye",
+    "bye",
+    "see you",
+    "see ya",
+    "talk to you later",
+    "talk later",
+    "have a good day",
+    "have a nice day",
+    "thanks anyway",
+    "ok bye",
+    "okay bye",
+    "call you back",
+    "i will call back",
+    "i'll call back",
+    "maybe later",
+    "not interested",
+)
+REPEAT_PHRASES = (
+    "say again",
+    "say that again",
+    "can you say again",
+    "could you say again",
+    "repeat that",
+    "repeat it",
+    "can you repeat",
+    "could you repeat",
+    "i did not hear",
+    "i didn't hear",
+    "i did not catch",
+    "i didn't catch",
+    "what did you say",
+    "come again",
+    "pardon",
+    "sorry can you repeat",
+)
 AVAILABILITY_KEYWORDS = {
     "available",
     "availability",
@@ -100,3 +166,14 @@ AVAILABILITY_KEYWORDS = {
     "december",
 }
 DATE_RE = re.compile(r"\b20\d{2}-\d{1,2}-\d{1,2}\b")
+# Keywords must be whole [a-z0-9] tokens, as if the text had been split
+# with re.findall(r"[a-z0-9]+", ...).
+AVAILABILITY_RE = re.compile(
+    r"(?<![a-z0-9])(?:"
+    + "|".join(sorted(AVAILABILITY_KEYWORDS, key=len, reverse=True))
+    + r")(?![a-z0-9])|"
+    + DATE_RE.pattern,
+    re.IGNORECASE,
+)
+END_CALL_RE = re.compile("|".join(map(re.escape, END_CALL_PHRASES)))
+REPEAT_RE = re.compile("|".join(map(re.escape, REPEAT_PHRASES)))
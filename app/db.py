@@ -1,11 +1,30 @@
 import sqlite3
+import threading
 
 from .config import DB_PATH
 
 
-def get_db():
+# One connection per thread. Nothing else references it, so it is closed
+# when its thread exits and the thread-local storage is released.
+_local = threading.local()
+
+
+def _connect():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA optimize")
+    return conn
+
+
+def get_db():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
     return conn
 
 
@@ -20,6 +39,9 @@ def init_db(conn):
         )
         """
     )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_role_id ON messages(role, id DESC)"
+    )
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS meta (
@@ -28,6 +50,23 @@ def init_db(conn):
         )
         """
     )
+    # Cached replies are scoped to one call; tables from before that have no
+    # call_sid column and are simply dropped, since they only hold a cache.
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(reply_cache)")}
+    if columns and "call_sid" not in columns:
+        conn.execute("DROP TABLE reply_cache")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reply_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            call_sid TEXT NOT NULL,
+            context_hash TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            reply TEXT NOT NULL,
+            last_used REAL NOT NULL
+        )
+        """
+    )
     conn.commit()
 
 
@@ -37,56 +76,86 @@ def get_meta(conn, key):
 
 
 def set_meta(conn, key, value):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+
+def _clear_conversation(conn):
+    conn.execute("DELETE FROM messages")
     conn.execute(
-        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
-        (key, value),
+        "DELETE FROM meta WHERE key IN (?, ?)",
+        ("conversation_summary", "summary_upto"),
     )
-    conn.commit()
+    conn.execute("DELETE FROM reply_cache")
 
 
-def delete_meta(conn, key):
-    conn.execute("DELETE FROM meta WHERE key = ?", (key,))
-    conn.commit()
+def reset_conversation(conn):
+    with conn:
+        _clear_conversation(conn)
 
 
-def reset_conversation(conn):
-    conn.execute("DELETE FROM messages")
-    conn.commit()
+def save_messages(messages):
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (role, content) VALUES (?, ?)",
+            messages,
+        )
 
 
-def save_message(role, content):
+def persist_turn(call_sid, role, content):
     conn = get_db()
-    try:
-        init_db(conn)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if call_sid and get_meta(conn, "call_sid") != call_sid:
+            _clear_conversation(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("call_sid", call_sid),
+            )
         conn.execute(
             "INSERT INTO messages (role, content) VALUES (?, ?)",
             (role, content),
         )
-        conn.commit()
-    finally:
-        conn.close()
 
 
-def load_messages():
+def load_messages(after_id=0):
     conn = get_db()
-    try:
-        init_db(conn)
-        rows = conn.execute(
-            "SELECT role, content FROM messages ORDER BY id ASC"
-        ).fetchall()
-    finally:
-        conn.close()
+    rows = conn.execute(
+        "SELECT role, content FROM messages WHERE id > ? ORDER BY id ASC",
+        (after_id,),
+    ).fetchall()
     return [{"role": row["role"], "content": row["content"]} for row in rows]
 
 
+def load_overflow_messages(after_id, limit):
+    """Messages newer than after_id that no longer fit in the last `limit`."""
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, role, content FROM messages
+        WHERE id > ? AND id < (
+            SELECT MIN(id) FROM (
+                SELECT id FROM messages ORDER BY id DESC LIMIT ?
+            )
+        )
+        ORDER BY id ASC
+        """,
+        (after_id, limit),
+    ).fetchall()
+    return [
+        {"id": row["id"], "role": row["role"], "content": row["content"]}
+        for row in rows
+    ]
+
+
 def get_last_assistant_message():
     conn = get_db()
-    try:
-        init_db(conn)
-        row = conn.execute(
-            "SELECT content FROM messages WHERE role = ? ORDER BY id DESC LIMIT 1",
-            ("assistant",),
-        ).fetchone()
-    finally:
-        conn.close()
+    row = conn.execute(
+        "SELECT content FROM messages WHERE role = ? ORDER BY id DESC LIMIT 1",
+        ("assistant",),
+    ).fetchone()
     return row["content"] if row else ""
@@ -1,142 +1,117 @@
+from xml.sax.saxutils import escape as xml_escape
+
 from flask import Blueprint, Response, request
-from twilio.twiml.voice_response import Gather, VoiceResponse
 
-from ..assistant import generate_reply, should_use_booking_context
-from ..call_state import ensure_call_context, pop_pending_user_text, set_pending_user_text
-from ..db import get_last_assistant_message, save_message
+from ..assistant import generate_reply
+from ..call_state import (
+    clear_pending_reply,
+    ensure_call_context,
+    pop_pending_user_text,
+    set_pending_user_text,
+    start_pending_reply,
+    wait_pending_reply,
+)
+from ..config import AVAILABILITY_RE, END_CALL_RE, REPEAT_RE
+from ..db import get_last_assistant_message, persist_turn
 
 voice_bp = Blueprint("voice", __name__)
 
-_END_CALL_PHRASES = (
-    "thanks for your time",
-    "thank you for your time",
-    "goodbye",
-    "good bye",
-    "bye",
-    "see you",
-    "see ya",
-    "talk to you later",
-    "talk later",
-    "have a good day",
-    "have a nice day",
-    "thanks anyway",
-    "ok bye",
-    "okay bye",
-    "call you back",
-    "i will call back",
-    "i'll call back",
-    "maybe later",
-    "not interested",
+# How long /voice/answer blocks waiting for the first (or next) streamed
+# sentence before telling Twilio to pause and poll again; well under Twilio's
+# 15 second webhook timeout.
+_ANSWER_WAIT_SECONDS = 10
+
+# The TwiML skeleton is the same every turn, so it is kept as preformatted
+# strings; only spoken text is escaped and substituted per request.
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+_SAY = '<Say voice="Polly.Joanna">%s</Say>'
+_GATHER = (
+    '<Gather action="/voice/respond" input="speech" method="POST" '
+    'speechTimeout="auto" />'
 )
-
-_REPEAT_PHRASES = (
-    "say again",
-    "say that again",
-    "can you say again",
-    "could you say again",
-    "repeat that",
-    "repeat it",
-    "can you repeat",
-    "could you repeat",
-    "i did not hear",
-    "i didn't hear",
-    "i did not catch",
-    "i didn't catch",
-    "what did you say",
-    "come again",
-    "pardon",
-    "sorry can you repeat",
+_REDIRECT_VOICE = '<Redirect method="POST">/voice</Redirect>'
+_REDIRECT_ANSWER = '<Redirect method="POST">/voice/answer</Redirect>'
+_GREETING = (
+    '<Gather action="/voice/respond" input="speech" method="POST" '
+    'speechTimeout="auto">'
+    '<Say voice="Polly.Joanna">Hello! Thanks for calling. Welcome to superstar motel. '
+    "How can I help you today?</Say></Gather>" + _REDIRECT_VOICE
+)
+_NOT_HEARD = (
+    '<Say voice="Polly.Joanna">Sorry, I didn\'t catch that. Please say that again.</Say>'
+    + _REDIRECT_VOICE
+)
+_GOODBYE = (
+    '<Say voice="Polly.Joanna">Thanks for calling. Feel free to call again if you need '
+    "anything else. Goodbye.</Say><Hangup />"
 )
+_CHECKING = '<Say voice="Polly.Joanna">Sure, let me check for you.</Say>' + _REDIRECT_ANSWER
+_PAUSE = '<Pause length="1" />'
 
 
-def should_end_call(user_text):
+def classify(user_text):
     if not user_text:
-        return False
+        return None
     lowered = user_text.lower()
-    return any(phrase in lowered for phrase in _END_CALL_PHRASES)
+    if END_CALL_RE.search(lowered):
+        return "end"
+    if REPEAT_RE.search(lowered):
+        return "repeat"
+    if AVAILABILITY_RE.search(lowered):
+        return "booking"
+    return None
+
+
+def _twiml(body):
+    return Response(
+        _XML_DECLARATION + "<Response>" + body + "</Response>",
+        mimetype="text/xml",
+    )
 
 
-def should_repeat(user_text):
-    if not user_text:
-        return False
-    lowered = user_text.lower()
-    return any(phrase in lowered for phrase in _REPEAT_PHRASES)
+def _say(text):
+    return _SAY % xml_escape(text)
 
 
-def build_gather():
-    return Gather(
-        input="speech",
-        action="/voice/respond",
-        method="POST",
-        speech_timeout="auto",
-    )
+def _reply_twiml(text):
+    return _twiml(_say(text) + _GATHER + _REDIRECT_VOICE)
 
 
 @voice_bp.route("/voice", methods=["POST"])
 def voice():
     call_sid = request.form.get("CallSid")
     ensure_call_context(call_sid)
-
-    resp = VoiceResponse()
-    gather = build_gather()
-    gather.say(
-        "Hello! Thanks for calling. Welcome to superstar motel. How can I help you today?",
-        voice="Polly.Joanna",
-    )
-    resp.append(gather)
-    resp.redirect("/voice", method="POST")
-    return Response(str(resp), mimetype="text/xml")
+    return _twiml(_GREETING)
 
 
 @voice_bp.route("/voice/respond", methods=["POST"])
 def voice_respond():
     call_sid = request.form.get("CallSid")
-    ensure_call_context(call_sid)
-
     user_text = request.form.get("SpeechResult", "").strip()
-    resp = VoiceResponse()
     if not user_text:
-        resp.say(
-            "Sorry, I didn't catch that. Please say that again.",
-            voice="Polly.Joanna",
-        )
-        resp.redirect("/voice", method="POST")
-        return Response(str(resp), mimetype="text/xml")
-
-    if should_end_call(user_text):
-        resp.say(
-            "Thanks for calling. Feel free to call again if you need anything else. Goodbye.",
-            voice="Polly.Joanna",
-        )
-        resp.hangup()
-        return Response(str(resp), mimetype="text/xml")
-
-    if should_repeat(user_text):
+        return _twiml(_NOT_HEARD)
+
+    intent = classify(user_text)
+    if intent == "end":
+        return _twiml(_GOODBYE)
+
+    if intent == "repeat":
+        ensure_call_context(call_sid)
         last_reply = get_last_assistant_message()
         if not last_reply:
             last_reply = "Sorry, I don't have that handy. Could you repeat your question?"
-        resp.say(last_reply, voice="Polly.Joanna")
-        gather = build_gather()
-        resp.append(gather)
-        resp.redirect("/voice", method="POST")
-        return Response(str(resp), mimetype="text/xml")
-
-    if should_use_booking_context(user_text):
-        save_message("user", user_text)
-        set_pending_user_text(user_text)
-        resp.say(
-            "Sure, let me check for you.",
-            voice="Polly.Joanna",
-        )
-        resp.redirect("/voice/answer", method="POST")
-        return Response(str(resp), mimetype="text/xml")
-
-    reply = generate_reply(user_text, save_user=True)
-    resp.say(reply, voice="Polly.Joanna")
-    gather = build_gather()
-    resp.append(gather)
-    resp.redirect("/voice", method="POST")
-    return Response(str(resp), mimetype="text/xml")
+        return _reply_twiml(last_reply)
+
+    if intent == "booking":
+        persist_turn(call_sid, "user", user_text)
+        set_pending_user_text(call_sid, user_text)
+        # Generate while Twilio reads the filler; /voice/answer collects it.
+        start_pending_reply(call_sid, generate_reply, user_text, False)
+        return _twiml(_CHECKING)
+
+    persist_turn(call_sid, "user", user_text)
+    reply = generate_reply(user_text, save_user=False)
+    return _reply_twiml(reply)
 
 
 @voice_bp.route("/voice/answer", methods=["POST"])
@@ -144,27 +119,25 @@ def voice_answer():
     call_sid = request.form.get("CallSid")
     ensure_call_context(call_sid)
 
-    user_text = pop_pending_user_text()
-    resp = VoiceResponse()
+    pending = wait_pending_reply(call_sid, _ANSWER_WAIT_SECONDS)
+    if pending is not None:
+        texts, finished = pending
+        spoken = "".join(_say(text.strip()) for text in texts)
+        if not finished:
+            # Speak the sentences streamed so far and come back for the rest.
+            return _twiml((spoken or _PAUSE) + _REDIRECT_ANSWER)
+        clear_pending_reply(call_sid)
+        pop_pending_user_text(call_sid)
+        return _twiml(spoken + _GATHER + _REDIRECT_VOICE)
+
+    # No background reply was started for this call: fall back to answering
+    # the pending text inline.
+    user_text = pop_pending_user_text(call_sid)
     if not user_text:
-        resp.say(
-            "Sorry, I didn't catch that. Please say that again.",
-            voice="Polly.Joanna",
-        )
-        resp.redirect("/voice", method="POST")
-        return Response(str(resp), mimetype="text/xml")
-
-    if should_end_call(user_text):
-        resp.say(
-            "Thanks for calling. Feel free to call again if you need anything else. Goodbye.",
-            voice="Polly.Joanna",
-        )
-        resp.hangup()
-        return Response(str(resp), mimetype="text/xml")
+        return _twiml(_NOT_HEARD)
+
+    if classify(user_text) == "end":
+        return _twiml(_GOODBYE)
 
     reply = generate_reply(user_text, save_user=False)
-    resp.say(reply, voice="Polly.Joanna")
-    gather = build_gather()
-    resp.append(gather)
-    resp.redirect("/voice", method="POST")
-    return Response(str(resp), mimetype="text/xml")
+    return _reply_twiml(reply)
@@ -0,0 +1,69 @@
+import hashlib
+import time
+
+import numpy as np
+
+from .config import SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD
+from .db import get_db
+
+
+def context_hash(context):
+    return hashlib.sha256((context or "").encode("utf-8")).hexdigest()
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def lookup_reply(embedding, context_key, call_sid):
+    # Replies may draw on the caller's own history, so they are only ever
+    # reused within the call that produced them.
+    query = _normalize(embedding)
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, embedding, reply FROM reply_cache
+        WHERE call_sid = ? AND context_hash = ?
+        """,
+        (call_sid, context_key),
+    ).fetchall()
+    rows = [row for row in rows if len(row["embedding"]) == query.nbytes]
+    if not rows:
+        return None
+    matrix = np.vstack(
+        [np.frombuffer(row["embedding"], dtype=np.float32) for row in rows]
+    )
+    scores = matrix @ query
+    best = int(np.argmax(scores))
+    if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    with conn:
+        conn.execute(
+            "UPDATE reply_cache SET last_used = ? WHERE id = ?",
+            (time.time(), rows[best]["id"]),
+        )
+    return rows[best]["reply"]
+
+
+def store_reply(embedding, context_key, call_sid, reply):
+    conn = get_db()
+    # The pooled connection outlives this call, so a failed write must roll
+    # back rather than leave its transaction open for the next request.
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO reply_cache (call_sid, context_hash, embedding, reply, last_used)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (call_sid, context_key, _normalize(embedding).tobytes(), reply, time.time()),
+        )
+        conn.execute(
+            """
+            DELETE FROM reply_cache WHERE id NOT IN (
+                SELECT id FROM reply_cache ORDER BY last_used DESC LIMIT ?
+            )
+            """,
+            (SEMANTIC_CACHE_SIZE,),
+        )
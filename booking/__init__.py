@@ -1,3 +1,9 @@
 from .context import build_booking_context
+from .embeddings import cached_query_embedding, embed_query, get_client
 
-__all__ = ["build_booking_context"]
+__all__ = [
+    "build_booking_context",
+    "cached_query_embedding",
+    "embed_query",
+    "get_client",
+]
@@ -0,0 +1,30 @@
+import argparse
+import os
+
+from .embeddings import _default_db_path
+from .index import _ensure_index
+
+
+def main(argv=None):
+    # Builds the index outside the webhook, e.g. before deploying a large CSV.
+    # Readers keep using the previous rows until the rebuild commits.
+    parser = argparse.ArgumentParser(
+        prog="python -m booking", description="Build the booking embedding index."
+    )
+    parser.add_argument("csv_path")
+    parser.add_argument(
+        "--db",
+        dest="db_path",
+        default=os.environ.get("BOOKING_DB_PATH") or _default_db_path(),
+    )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="embed through the OpenAI Batch API (half price, may take hours)",
+    )
+    args = parser.parse_args(argv)
+    _ensure_index(args.csv_path, args.db_path, use_batch_api=args.batch_api)
+
+
+if __name__ == "__main__":
+    main()
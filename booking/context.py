@@ -1,25 +1,53 @@
+import os
 import re
+import threading
+from collections import OrderedDict
+from datetime import date
 
 from .search import find_relevant_rows
 
-_AVAILABILITY_TERMS = {
-    "available",
-    "availability",
-    "vacant",
-    "vacancy",
-    "open",
-    "free",
-}
+_AVAILABILITY_TERMS = ("availability", "available", "vacancy", "vacant", "open", "free")
+# All terms in one alternation, bounded the way _tokenize splits words, so a
+# single C-level scan answers "does any token match".
+_AVAILABILITY_RE = re.compile(
+    r"(?<![a-z0-9])(?:" + "|".join(_AVAILABILITY_TERMS) + r")(?![a-z0-9])"
+)
+_SAMPLE_FIELDS = (
+    "date",
+    "room_number",
+    "room_type",
+    "status",
+    "check_in",
+    "check_out",
+    "guest_name",
+    "booking_id",
+    "nightly_rate_nzd",
+    "notes",
+    "floor",
+    "bed_setup",
+    "max_guests",
+    "room_size_sqm",
+    "kitchenette",
+    "amenities",
+    "view",
+    "accessible",
+    "room_type_description",
+    "rate_source",
+    "pricing_reason",
+)
 _ROOM_NUMBER_RE = re.compile(r"\b(room numbers?|room #|room no\.?|which room)\b")
+_CONTEXT_CACHE_SIZE = 256
+_context_cache = OrderedDict()
+_context_cache_lock = threading.Lock()
 
 
 def _wants_availability(query):
-    tokens = set(re.findall(r"[a-z0-9]+", (query or "").lower()))
-    return bool(tokens & _AVAILABILITY_TERMS)
+    return _AVAILABILITY_RE.search((query or "").lower()) is not None
 
 
 def _wants_room_numbers(query):
-    return bool(_ROOM_NUMBER_RE.search((query or "").lower()))
+    lowered = (query or "").lower()
+    return "room" in lowered and _ROOM_NUMBER_RE.search(lowered) is not None
 
 
 def _format_room_number_list(room_numbers, preview_limit=4):
@@ -30,7 +58,38 @@ def _format_room_number_list(room_numbers, preview_limit=4):
     return ", ".join(preview), remaining
 
 
+def _normalize_query(query):
+    return " ".join((query or "").lower().split())
+
+
 def build_booking_context(query, csv_path, max_rows=5, db_path=None):
+    query = _normalize_query(query)
+    try:
+        csv_mtime = os.stat(csv_path).st_mtime_ns
+    except OSError:
+        csv_mtime = None
+    # Relative dates ("tomorrow") resolve against today, so the day is part of
+    # the key. Empty results are not cached: they usually mean a transient
+    # OpenAI failure rather than a real answer. Neither are answers from an
+    # index that could not be rebuilt for the current CSV.
+    key = (query, csv_path, csv_mtime, max_rows, db_path, date.today())
+    with _context_cache_lock:
+        context = _context_cache.get(key)
+        if context is not None:
+            _context_cache.move_to_end(key)
+            return context
+    context, current = _build_booking_context(
+        query, csv_path, max_rows=max_rows, db_path=db_path
+    )
+    if context and current:
+        with _context_cache_lock:
+            _context_cache[key] = context
+            while len(_context_cache) > _CONTEXT_CACHE_SIZE:
+                _context_cache.popitem(last=False)
+    return context
+
+
+def _build_booking_context(query, csv_path, max_rows=5, db_path=None):
     wants_room_numbers = _wants_room_numbers(query)
     availability_only = _wants_availability(query) or wants_room_numbers
     rows, summary = find_relevant_rows(
@@ -42,7 +101,7 @@ def build_booking_context(query, csv_path, max_rows=5, db_path=None):
         availability_only=availability_only,
     )
     if not rows and not summary:
-        return ""
+        return "", False
 
     lines = [
         "Booking availability summary from the motel availability CSV.",
@@ -118,36 +177,6 @@ def build_booking_context(query, csv_path, max_rows=5, db_path=None):
         lines.append("Sample rows (up to {max_rows}):".format(max_rows=max_rows))
         for row in rows:
             lines.append(
-                "- date: {date}, room_number: {room_number}, room_type: {room_type}, "
-                "status: {status}, check_in: {check_in}, check_out: {check_out}, "
-                "guest_name: {guest_name}, booking_id: {booking_id}, "
-                "nightly_rate_nzd: {nightly_rate_nzd}, notes: {notes}, "
-                "floor: {floor}, bed_setup: {bed_setup}, max_guests: {max_guests}, "
-                "room_size_sqm: {room_size_sqm}, kitchenette: {kitchenette}, "
-                "amenities: {amenities}, view: {view}, accessible: {accessible}, "
-                "room_type_description: {room_type_description}, rate_source: {rate_source}, "
-                "pricing_reason: {pricing_reason}".format(
-                    date=row.get("date", ""),
-                    room_number=row.get("room_number", ""),
-                    room_type=row.get("room_type", ""),
-                    status=row.get("status", ""),
-                    check_in=row.get("check_in", ""),
-                    check_out=row.get("check_out", ""),
-                    guest_name=row.get("guest_name", ""),
-                    booking_id=row.get("booking_id", ""),
-                    nightly_rate_nzd=row.get("nightly_rate_nzd", ""),
-                    notes=row.get("notes", ""),
-                    floor=row.get("floor", ""),
-                    bed_setup=row.get("bed_setup", ""),
-                    max_guests=row.get("max_guests", ""),
-                    room_size_sqm=row.get("room_size_sqm", ""),
-                    kitchenette=row.get("kitchenette", ""),
-                    amenities=row.get("amenities", ""),
-                    view=row.get("view", ""),
-                    accessible=row.get("accessible", ""),
-                    room_type_description=row.get("room_type_description", ""),
-                    rate_source=row.get("rate_source", ""),
-                    pricing_reason=row.get("pricing_reason", ""),
-                )
+                "- " + ", ".join(f"{field}: {row.get(field, '')}" for field in _SAMPLE_FIELDS)
             )
-    return "\n".join(lines)
+    return "\n".join(lines), bool(summary and summary.get("index_current", True))
@@ -1,9 +1,50 @@
+import hashlib
 import os
+import sqlite3
+import threading
+import time
 from functools import lru_cache
 
+import numpy as np
 from openai import OpenAI
 
 EMBED_MODEL = os.environ.get("BOOKING_EMBED_MODEL", "text-embedding-3-small")
+_QUERY_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+try:
+    OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "8"))
+except ValueError:
+    OPENAI_TIMEOUT = 8.0
+try:
+    OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "0"))
+except ValueError:
+    OPENAI_MAX_RETRIES = 0
+_query_cache_ready = set()
+_query_cache_lock = threading.Lock()
+_client = None
+_client_lock = threading.Lock()
+
+
+def _default_db_path():
+    return "/tmp/booking_vectors.db" if os.environ.get("VERCEL") else "booking_vectors.db"
+
+
+def get_client():
+    # One client per process, shared with the chat completions in app, keeps
+    # a single connection pool warm. Twilio abandons a webhook after 15
+    # seconds, so calls made while answering must fail fast instead of
+    # pinning the worker: a retry would double the wait, so there are none by
+    # default. Index rebuilds loosen this with with_options and retry
+    # rate limits themselves.
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    timeout=OPENAI_TIMEOUT,
+                    max_retries=OPENAI_MAX_RETRIES,
+                )
+    return _client
 
 
 def _embed_texts(client, texts):
@@ -11,8 +52,94 @@ def _embed_texts(client, texts):
     return [item.embedding for item in response.data]
 
 
+def _query_cache_conn(db_path):
+    # The cache lives next to the booking index it serves.
+    db_path = db_path or _default_db_path()
+    conn = sqlite3.connect(db_path)
+    if db_path not in _query_cache_ready:
+        with _query_cache_lock:
+            if db_path not in _query_cache_ready:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS query_embedding_cache (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        created_at INTEGER NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    "DELETE FROM query_embedding_cache WHERE created_at < ?",
+                    (int(time.time()) - _QUERY_CACHE_TTL_SECONDS,),
+                )
+                conn.commit()
+                _query_cache_ready.add(db_path)
+    return conn
+
+
+def _load_query_embedding(db_path, key):
+    try:
+        conn = _query_cache_conn(db_path)
+        try:
+            row = conn.execute(
+                "SELECT embedding FROM query_embedding_cache WHERE key = ?", (key,)
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+
+def _store_query_embedding(db_path, key, model, embedding):
+    try:
+        conn = _query_cache_conn(db_path)
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO query_embedding_cache (
+                        key, model, embedding, created_at
+                    )
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (key, model, embedding.tobytes(), int(time.time())),
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def _query_cache_key(model, query):
+    # Ignores case and spacing, so "Any rooms  free?" and "any rooms free?"
+    # share one embedding.
+    return hashlib.blake2b(
+        f"{model}\0{' '.join(query.lower().split())}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
 @lru_cache(maxsize=128)
-def _embed_query_cached(model, query):
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    response = client.embeddings.create(model=model, input=[query])
-    return response.data[0].embedding
+def _embed_query_cached(model, query, db_path=None):
+    # The in-process LRU sits in front of a SQLite cache, which survives cold
+    # starts; a cache failure only costs an extra API call.
+    key = _query_cache_key(model, query)
+    embedding = _load_query_embedding(db_path, key)
+    if embedding is not None:
+        return embedding
+    response = get_client().embeddings.create(model=model, input=[query])
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    embedding.setflags(write=False)
+    _store_query_embedding(db_path, key, model, embedding)
+    return embedding
+
+
+def embed_query(query, db_path=None):
+    return _embed_query_cached(EMBED_MODEL, query, db_path)
+
+
+def cached_query_embedding(query, db_path=None):
+    # Only returns an embedding an earlier call already paid for; never calls
+    # the API.
+    return _load_query_embedding(db_path, _query_cache_key(EMBED_MODEL, query))
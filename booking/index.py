@@ -1,24 +1,174 @@
 import csv
-import json
 import os
+import random
+import re
 import sqlite3
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI, OpenAIError
+import numpy as np
+import orjson
+from openai import OpenAIError, RateLimitError
 
-from .embeddings import EMBED_MODEL, _embed_texts
+from .embeddings import EMBED_MODEL, _embed_texts, get_client
+from .parsing import _is_available, _normalize_room_type
 
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
 
-def _default_db_path():
-    return "/tmp/booking_vectors.db" if os.environ.get("VERCEL") else "booking_vectors.db"
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# Bump whenever the booking_vectors layout changes.
+_SCHEMA_VERSION = "3"
+_ROW_FIELDS = (
+    "date",
+    "room_number",
+    "room_type",
+    "status",
+    "booking_id",
+    "guest_name",
+    "check_in",
+    "check_out",
+    "channel",
+    "nightly_rate_nzd",
+    "notes",
+    "floor",
+    "bed_setup",
+    "max_guests",
+    "room_size_sqm",
+    "kitchenette",
+    "amenities",
+    "view",
+    "accessible",
+    "room_type_description",
+    "rate_source",
+    "pricing_reason",
+)
+_EMBED_WORKERS = 10
+_EMBED_RETRIES = 5
+_EMBED_BATCH_SIZE = 100
+_REBUILD_TIMEOUT_SECONDS = 60
+_BATCH_API_POLL_SECONDS = 10
+try:
+    _BATCH_API_TIMEOUT_SECONDS = float(os.environ.get("BOOKING_BATCH_API_TIMEOUT", "21600"))
+except ValueError:
+    _BATCH_API_TIMEOUT_SECONDS = 21600.0
 
 
 def _get_conn(db_path):
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
 
+def _load_vec(conn):
+    # sqlite-vec is optional: without the package, or on a Python build that
+    # cannot load extensions, search falls back to scoring rows in Python.
+    if sqlite_vec is None or not hasattr(conn, "enable_load_extension"):
+        return False
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def _has_vec_table(conn):
+    # Tables created before the filter columns existed are treated as
+    # missing so the next rebuild recreates them.
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'booking_vec'"
+    ).fetchone()
+    return row is not None and "room_type" in row[0]
+
+
+def _vec_dimensions(conn):
+    if not _has_vec_table(conn):
+        return None
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'booking_vec'"
+    ).fetchone()
+    match = re.search(r"float\[(\d+)\]", row[0])
+    return int(match.group(1)) if match else None
+
+
+def _pack_embedding(embedding):
+    return struct.pack(f"{len(embedding)}f", *embedding)
+
+
+def _normalize_vectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _embeddings_path(db_path):
+    return db_path + ".emb"
+
+
+def _write_embedding_file(conn, path, embeddings):
+    # Normalized float32 rows in row_index order, memory-mapped by search so
+    # processes share the matrix through the page cache instead of decoding
+    # blobs. The shape is only recorded once the file is fully in place.
+    matrix = _normalize_vectors(embeddings)
+    temp_path = path + ".tmp"
+    try:
+        matrix.tofile(temp_path)
+        os.replace(temp_path, path)
+    except OSError:
+        return
+    _set_meta(conn, "embedding_shape", "{},{}".format(*matrix.shape))
+
+
+def _load_embedding_file(conn, path, csv_path, count):
+    shape = _get_meta(conn, "embedding_shape")
+    if not shape or not count or _get_meta(conn, "csv_path") != csv_path:
+        return None
+    rows, dimensions = (int(value) for value in shape.split(","))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if rows != count or size != rows * dimensions * 4:
+        return None
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dimensions))
+
+
 def _init_db(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS booking_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """
+    )
+    # Databases written with another layout (e.g. JSON-text embeddings) are
+    # dropped along with their metadata, so _ensure_index rebuilds them.
+    if _get_meta(conn, "schema_version") != _SCHEMA_VERSION:
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS booking_vectors")
+            conn.execute("DELETE FROM booking_meta")
+            conn.execute(
+                "INSERT INTO booking_meta (key, value) VALUES ('schema_version', ?)",
+                (_SCHEMA_VERSION,),
+            )
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS booking_vectors (
@@ -27,38 +177,18 @@ def _init_db(conn):
             row_index INTEGER NOT NULL,
             row_json TEXT NOT NULL,
             row_text TEXT NOT NULL,
-            embedding_json TEXT NOT NULL
+            embedding BLOB NOT NULL
         )
         """
     )
+    # Every read filters on csv_path and walks rows in row_index order.
     conn.execute(
         """
-        CREATE TABLE IF NOT EXISTS booking_meta (
-            key TEXT PRIMARY KEY,
-            value TEXT NOT NULL
-        )
+        CREATE INDEX IF NOT EXISTS booking_vectors_csv_path
+        ON booking_vectors (csv_path, row_index)
         """
     )
     conn.commit()
-    columns = {
-        row["name"]
-        for row in conn.execute("PRAGMA table_info(booking_vectors)").fetchall()
-    }
-    if "row_text" not in columns:
-        conn.execute("DROP TABLE IF EXISTS booking_vectors")
-        conn.execute(
-            """
-            CREATE TABLE booking_vectors (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                csv_path TEXT NOT NULL,
-                row_index INTEGER NOT NULL,
-                row_json TEXT NOT NULL,
-                row_text TEXT NOT NULL,
-                embedding_json TEXT NOT NULL
-            )
-            """
-        )
-        conn.commit()
 
 
 def _get_meta(conn, key):
@@ -75,127 +205,294 @@ def _set_meta(conn, key, value):
 
 
 def _format_row_text(row):
-    return (
-        "date: {date}; room_number: {room_number}; room_type: {room_type}; "
-        "status: {status}; booking_id: {booking_id}; guest_name: {guest_name}; "
-        "check_in: {check_in}; check_out: {check_out}; channel: {channel}; "
-        "nightly_rate_nzd: {nightly_rate_nzd}; notes: {notes}; "
-        "floor: {floor}; bed_setup: {bed_setup}; max_guests: {max_guests}; "
-        "room_size_sqm: {room_size_sqm}; kitchenette: {kitchenette}; "
-        "amenities: {amenities}; view: {view}; accessible: {accessible}; "
-        "room_type_description: {room_type_description}; rate_source: {rate_source}; "
-        "pricing_reason: {pricing_reason}"
-    ).format(
-        date=row.get("date", ""),
-        room_number=row.get("room_number", ""),
-        room_type=row.get("room_type", ""),
-        status=row.get("status", ""),
-        booking_id=row.get("booking_id", ""),
-        guest_name=row.get("guest_name", ""),
-        check_in=row.get("check_in", ""),
-        check_out=row.get("check_out", ""),
-        channel=row.get("channel", ""),
-        nightly_rate_nzd=row.get("nightly_rate_nzd", ""),
-        notes=row.get("notes", ""),
-        floor=row.get("floor", ""),
-        bed_setup=row.get("bed_setup", ""),
-        max_guests=row.get("max_guests", ""),
-        room_size_sqm=row.get("room_size_sqm", ""),
-        kitchenette=row.get("kitchenette", ""),
-        amenities=row.get("amenities", ""),
-        view=row.get("view", ""),
-        accessible=row.get("accessible", ""),
-        room_type_description=row.get("room_type_description", ""),
-        rate_source=row.get("rate_source", ""),
-        pricing_reason=row.get("pricing_reason", ""),
-    )
+    return "; ".join(f"{field}: {row.get(field, '')}" for field in _ROW_FIELDS)
+
+
+def _load_rows_arrow(csv_path, header):
+    # pyarrow parses in C. Every column is read as a non-null string so the
+    # rows match the csv module path; ragged files fall back to it.
+    try:
+        table = pa_csv.read_csv(
+            csv_path,
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pa.string() for name in header},
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+    except (pa.ArrowInvalid, OSError):
+        return None
+    names = table.column_names
+    columns = [pc.utf8_trim_whitespace(column).to_pylist() for column in table.columns]
+    return [dict(zip(names, values)) for values in zip(*columns)]
 
 
 def _load_rows(csv_path):
-    rows = []
     with open(csv_path, newline="", encoding="utf-8") as handle:
-        reader = csv.DictReader(handle)
-        for row in reader:
-            rows.append({key: (value or "").strip() for key, value in row.items()})
-    return rows
+        reader = csv.reader(handle)
+        header = next(reader, None)
+        if not header:
+            return []
+        if pa is not None and len(set(header)) == len(header):
+            rows = _load_rows_arrow(csv_path, header)
+            if rows is not None:
+                return rows
+        return [dict(zip(header, map(str.strip, values))) for values in reader if values]
 
 
-def _rebuild_index(conn, csv_path, rows):
-    conn.execute("DELETE FROM booking_vectors WHERE csv_path = ?", (csv_path,))
-    conn.commit()
+def _retry_delay(error, attempt):
+    # Prefer the server's Retry-After hint; otherwise back off exponentially.
+    # Jitter keeps parallel batches from retrying in lockstep.
+    response = getattr(error, "response", None)
+    try:
+        delay = float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        delay = 2**attempt
+    return delay + random.random()
+
+
+def _embed_batch(client, texts):
+    # Parallel batches tend to hit the per-minute token limit together, so
+    # rate limits are retried here rather than failing the whole rebuild.
+    for attempt in range(_EMBED_RETRIES):
+        try:
+            return _embed_texts(client, texts)
+        except RateLimitError as error:
+            if attempt == _EMBED_RETRIES - 1:
+                raise
+            time.sleep(_retry_delay(error, attempt))
+
+
+def _embed_concurrently(client, texts):
+    batches = [
+        texts[start : start + _EMBED_BATCH_SIZE]
+        for start in range(0, len(texts), _EMBED_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=min(_EMBED_WORKERS, len(batches))) as executor:
+        return [
+            embedding
+            for batch in executor.map(lambda batch: _embed_batch(client, batch), batches)
+            for embedding in batch
+        ]
+
+
+def _embed_with_batch_api(client, texts):
+    # The Batch API costs half as much but completes asynchronously (within
+    # 24 hours), so it is only used by explicit builds (see main), never from
+    # a query.
+    lines = [
+        orjson.dumps(
+            {
+                "custom_id": str(start),
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {
+                    "model": EMBED_MODEL,
+                    "input": texts[start : start + _EMBED_BATCH_SIZE],
+                },
+            }
+        )
+        for start in range(0, len(texts), _EMBED_BATCH_SIZE)
+    ]
+    input_file = client.files.create(
+        file=("booking_index.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h",
+    )
+    deadline = time.monotonic() + _BATCH_API_TIMEOUT_SECONDS
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if time.monotonic() >= deadline:
+            try:
+                client.batches.cancel(batch.id)
+            except OpenAIError:
+                pass
+            raise OpenAIError(f"Embedding batch {batch.id} timed out as {batch.status}")
+        time.sleep(_BATCH_API_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise OpenAIError(f"Embedding batch {batch.id} ended as {batch.status}")
+
+    embeddings = [None] * len(texts)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        result = orjson.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            raise OpenAIError(f"Embedding batch request {result.get('custom_id')} failed")
+        start = int(result["custom_id"])
+        for item in response["body"]["data"]:
+            embeddings[start + item["index"]] = item["embedding"]
+    if any(embedding is None for embedding in embeddings):
+        raise OpenAIError(f"Embedding batch {batch.id} returned incomplete results")
+    return embeddings
+
+
+def _rebuild_index(
+    conn,
+    csv_path,
+    rows,
+    csv_mtime,
+    use_vec=False,
+    embeddings_path=None,
+    use_batch_api=False,
+):
+    # Rebuilds embed hundreds of rows per request, well past the webhook
+    # timeout the shared client is tuned for.
+    client = get_client().with_options(timeout=_REBUILD_TIMEOUT_SECONDS)
+    texts = [_format_row_text(row) for row in rows]
+    # Identical rows embed to the same vector, so each distinct text is sent
+    # once and the result is shared by every row that has it.
+    unique = {}
+    for text in texts:
+        unique.setdefault(text, len(unique))
+    unique_texts = list(unique)
+    if use_batch_api:
+        unique_embeddings = _embed_with_batch_api(client, unique_texts)
+    else:
+        unique_embeddings = _embed_concurrently(client, unique_texts)
+    embeddings = [unique_embeddings[unique[text]] for text in texts]
 
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    batch_size = 100
     to_insert = []
+    vectors = []
+    for idx, embedding in enumerate(embeddings):
+        packed = _pack_embedding(embedding)
+        to_insert.append(
+            (csv_path, idx, orjson.dumps(rows[idx]).decode(), texts[idx], packed)
+        )
+        vectors.append(
+            (
+                packed,
+                csv_path,
+                idx,
+                int(_is_available(rows[idx])),
+                _normalize_room_type(rows[idx].get("room_type")),
+            )
+        )
 
-    for start in range(0, len(rows), batch_size):
-        batch = rows[start : start + batch_size]
-        texts = [_format_row_text(row) for row in batch]
-        embeddings = _embed_texts(client, texts)
-        for offset, embedding in enumerate(embeddings):
-            idx = start + offset
-            to_insert.append(
-                (
+    # The old rows are only replaced once every batch has been embedded, and
+    # in one transaction together with the metadata that marks the index
+    # current, so a failed rebuild leaves the previous index intact.
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM booking_meta WHERE key = 'embedding_shape'")
+        conn.executemany(
+            "INSERT OR REPLACE INTO booking_meta (key, value) VALUES (?, ?)",
+            (
+                ("csv_path", csv_path),
+                ("csv_mtime", csv_mtime),
+                ("embed_model", EMBED_MODEL),
+            ),
+        )
+        conn.execute("DELETE FROM booking_vectors WHERE csv_path = ?", (csv_path,))
+        conn.executemany(
+            """
+            INSERT INTO booking_vectors (
+                csv_path,
+                row_index,
+                row_json,
+                row_text,
+                embedding
+            )
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            to_insert,
+        )
+        if use_vec and vectors:
+            # vec0 columns have a fixed width, so the table is only recreated
+            # when it is missing or sized for another embedding model; other
+            # CSVs' vectors are kept otherwise.
+            dimensions = len(vectors[0][0]) // 4
+            if _vec_dimensions(conn) == dimensions:
+                conn.execute("DELETE FROM booking_vec WHERE csv_path = ?", (csv_path,))
+            else:
+                conn.execute("DROP TABLE IF EXISTS booking_vec")
+            conn.execute(
+                f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS booking_vec USING vec0(
+                    embedding float[{dimensions}] distance_metric=cosine,
+                    csv_path text,
+                    row_index integer,
+                    available integer,
+                    room_type text
+                )
+                """
+            )
+            conn.executemany(
+                """
+                INSERT INTO booking_vec (
+                    embedding,
                     csv_path,
-                    idx,
-                    json.dumps(batch[offset]),
-                    texts[offset],
-                    json.dumps(embedding),
+                    row_index,
+                    available,
+                    room_type
                 )
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                vectors,
             )
-
-    conn.executemany(
-        """
-        INSERT INTO booking_vectors (
-            csv_path,
-            row_index,
-            row_json,
-            row_text,
-            embedding_json
-        )
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        to_insert,
-    )
-    conn.commit()
+    if embeddings_path:
+        _write_embedding_file(conn, embeddings_path, embeddings)
 
 
-def _ensure_index(csv_path, db_path):
+def _ensure_index(csv_path, db_path, use_batch_api=False):
+    """Bring the stored index up to date; return whether it matches the CSV."""
     csv_path = os.path.abspath(csv_path)
     if not os.path.exists(csv_path):
-        return
+        return False
 
     try:
         mtime = str(os.path.getmtime(csv_path))
     except OSError:
-        return
+        return False
 
     conn = _get_conn(db_path)
     try:
+        use_vec = _load_vec(conn)
         _init_db(conn)
         stored_path = _get_meta(conn, "csv_path")
         stored_mtime = _get_meta(conn, "csv_mtime")
         stored_model = _get_meta(conn, "embed_model")
-        row_count = conn.execute(
-            "SELECT COUNT(*) AS count FROM booking_vectors WHERE csv_path = ?",
-            (csv_path,),
-        ).fetchone()["count"]
+        has_rows = (
+            conn.execute(
+                "SELECT 1 FROM booking_vectors WHERE csv_path = ? LIMIT 1",
+                (csv_path,),
+            ).fetchone()
+            is not None
+        )
         if (
             stored_path == csv_path
             and stored_mtime == mtime
             and stored_model == EMBED_MODEL
-            and row_count > 0
+            and has_rows
+            and (not use_vec or _has_vec_table(conn))
         ):
-            return
+            return True
 
         rows = _load_rows(csv_path)
-        if rows:
-            try:
-                _rebuild_index(conn, csv_path, rows)
-            except OpenAIError:
-                return
-            _set_meta(conn, "csv_path", csv_path)
-            _set_meta(conn, "csv_mtime", mtime)
-            _set_meta(conn, "embed_model", EMBED_MODEL)
+        if not rows:
+            return False
+        try:
+            _rebuild_index(
+                conn,
+                csv_path,
+                rows,
+                mtime,
+                use_vec=use_vec,
+                embeddings_path=_embeddings_path(db_path),
+                use_batch_api=use_batch_api,
+            )
+        except OpenAIError:
+            # Queries keep serving the previous index; explicit builds
+            # report the failure.
+            if use_batch_api:
+                raise
+            return False
+        return True
     finally:
         conn.close()
+
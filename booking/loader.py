@@ -0,0 +1,84 @@
+import os
+import threading
+
+import numpy as np
+
+from .index import _load_rows
+from .parsing import _is_available, _normalize_room_type, _parse_date_str
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _room_type_catalog(rows):
+    # Distinct room types, most specific first, so detection can stop at the
+    # first one whose tokens all appear in the query.
+    room_types = {}
+    for row in rows:
+        room_type = row.get("room_type") or ""
+        normalized = _normalize_room_type(room_type)
+        if normalized:
+            room_types.setdefault(normalized, room_type)
+    catalog = sorted(
+        (
+            (len(normalized.split()), len(normalized), original, normalized)
+            for normalized, original in room_types.items()
+        ),
+        reverse=True,
+    )
+    return [(frozenset(normalized.split()), original) for _, _, original, normalized in catalog]
+
+
+def _build_table(rows, mtime):
+    # Column arrays (one entry per CSV row) so date, status and room-type
+    # filters run as NumPy masks instead of a Python loop over row dicts.
+    dates = np.array(
+        [
+            value.year * 10000 + value.month * 100 + value.day if value else -1
+            for value in (_parse_date_str(row.get("date", "")) for row in rows)
+        ],
+        dtype=np.int64,
+    )
+    room_numbers = np.array([row.get("room_number", "") for row in rows], dtype=str)
+    # Rows ordered by (date, room_number), so one exact date is a contiguous
+    # slice found by binary search, already in room-number order.
+    date_order = np.lexsort((room_numbers, dates))
+    return {
+        "mtime": mtime,
+        "rows": rows,
+        # YYYYMMDD, so the month-day fallback is just dates % 10000.
+        "dates": dates,
+        "date_order": date_order,
+        "sorted_dates": dates[date_order],
+        "room_numbers": room_numbers,
+        "room_types": np.array(
+            [_normalize_room_type(row.get("room_type")) for row in rows], dtype=str
+        ),
+        "available": np.array([_is_available(row) for row in rows], dtype=bool),
+        "room_type_catalog": _room_type_catalog(rows),
+    }
+
+
+def preload(csv_path):
+    csv_path = os.path.abspath(csv_path)
+    try:
+        mtime = os.stat(csv_path).st_mtime_ns
+    except OSError:
+        return None
+    table = _build_table(_load_rows(csv_path), mtime)
+    with _tables_lock:
+        _tables[csv_path] = table
+    return table
+
+
+def get_table(csv_path):
+    csv_path = os.path.abspath(csv_path)
+    try:
+        mtime = os.stat(csv_path).st_mtime_ns
+    except OSError:
+        return None
+    with _tables_lock:
+        table = _tables.get(csv_path)
+    if table is not None and table["mtime"] == mtime:
+        return table
+    return preload(csv_path)
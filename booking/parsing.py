@@ -2,36 +2,37 @@ import re
 from datetime import date, timedelta
 
 _TOKEN_RE = re.compile(r"[a-z0-9]+")
-_STOPWORDS = {
-    "a",
-    "an",
-    "and",
-    "are",
-    "at",
-    "be",
-    "can",
-    "do",
-    "for",
-    "have",
-    "i",
-    "in",
-    "is",
-    "it",
-    "me",
-    "of",
-    "on",
-    "or",
-    "our",
-    "please",
-    "the",
-    "to",
-    "us",
-    "we",
-    "with",
-    "you",
-    "your",
-}
-_DATE_RE = re.compile(r"\b(20\d{2})-(\d{1,2})-(\d{1,2})\b")
+_STOPWORDS = frozenset(
+    {
+        "a",
+        "an",
+        "and",
+        "are",
+        "at",
+        "be",
+        "can",
+        "do",
+        "for",
+        "have",
+        "i",
+        "in",
+        "is",
+        "it",
+        "me",
+        "of",
+        "on",
+        "or",
+        "our",
+        "please",
+        "the",
+        "to",
+        "us",
+        "we",
+        "with",
+        "you",
+        "your",
+    }
+)
 _MONTHS = {
     "jan": 1,
     "january": 1,
@@ -58,20 +59,6 @@ _MONTHS = {
     "dec": 12,
     "december": 12,
 }
-_MONTH_DAY_RE = re.compile(
-    r"\b(?P<day>\d{1,2})(?:st|nd|rd|th)?\s*(?:of\s+)?"
-    r"(?P<month>jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|"
-    r"jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|"
-    r"nov(?:ember)?|dec(?:ember)?)"
-    r"(?:\s*(?P<year>\d{4}))?\b"
-)
-_MONTH_DAY_RE_REV = re.compile(
-    r"\b(?P<month>jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|"
-    r"jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|"
-    r"nov(?:ember)?|dec(?:ember)?)\s*"
-    r"(?P<day>\d{1,2})(?:st|nd|rd|th)?"
-    r"(?:\s*(?P<year>\d{4}))?\b"
-)
 _WEEKDAYS = {
     "monday": 0,
     "tuesday": 1,
@@ -81,18 +68,60 @@ _WEEKDAYS = {
     "saturday": 5,
     "sunday": 6,
 }
-_WEEKDAY_RE = re.compile(
-    r"\b(?P<qualifier>next|this)?\s*"
-    r"(?P<weekday>monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b"
+_MONTH_PATTERN = (
+    r"jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|"
+    r"jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|"
+    r"nov(?:ember)?|dec(?:ember)?"
+)
+# Every date form in one pattern, listed in priority order. The alternation
+# sits in a lookahead so overlapping candidates are all seen in a single
+# scan; _resolve_query_date keeps the highest-priority, then leftmost, match.
+_QUERY_DATE_RE = re.compile(
+    r"(?=(?P<iso>\b(?P<iso_year>20\d{2})-(?P<iso_month>\d{1,2})-(?P<iso_day>\d{1,2})\b)"
+    r"|(?P<day_after_tomorrow>day after tomorrow)"
+    r"|(?P<tomorrow>tomorrow)"
+    r"|(?P<today>today)"
+    r"|(?P<day_month>\b(?P<dm_day>\d{1,2})(?:st|nd|rd|th)?\s*(?:of\s+)?"
+    r"(?P<dm_month>" + _MONTH_PATTERN + r")(?:\s*(?P<dm_year>\d{4}))?\b)"
+    r"|(?P<month_day>\b(?P<md_month>" + _MONTH_PATTERN + r")\s*"
+    r"(?P<md_day>\d{1,2})(?:st|nd|rd|th)?(?:\s*(?P<md_year>\d{4}))?\b)"
+    r"|(?P<weekday>\b(?P<qualifier>next|this)?\s*"
+    r"(?P<weekday_name>monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b))"
 )
+# Every date form above contains a digit, "day" (today and the weekday
+# names), "tomorrow" or a month name; most queries have none and skip the
+# overlapping scan entirely.
+_DATE_HINT_RE = re.compile(r"\d|day|tomorrow|" + _MONTH_PATTERN)
+_DATE_PRIORITY = {
+    "iso": 0,
+    "day_after_tomorrow": 1,
+    "tomorrow": 2,
+    "today": 3,
+    "day_month": 4,
+    "month_day": 5,
+    "weekday": 6,
+}
 
 
 def _tokenize(text):
     return _TOKEN_RE.findall(text.lower())
 
 
-def _query_tokens(query):
-    return {token for token in _tokenize(query) if token not in _STOPWORDS}
+def _query_tokens(tokens):
+    return frozenset(tokens) - _STOPWORDS
+
+
+def _normalize_status(value):
+    return (value or "").strip().lower()
+
+
+def _normalize_room_type(value):
+    return " ".join(_tokenize(value or "")).strip()
+
+
+def _is_available(row):
+    status = _normalize_status(row.get("status"))
+    return status in {"available", "vacant"} or status.startswith("available")
 
 
 def _parse_date_str(value):
@@ -104,55 +133,58 @@ def _parse_date_str(value):
         return None
 
 
-def _normalize_date(text):
-    if not text:
-        return None
-    match = _DATE_RE.search(text)
-    if not match:
-        return None
-    year, month, day = match.groups()
-    try:
-        return f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
-    except ValueError:
-        return None
-
-
 def _resolve_query_date(text):
     if not text:
         return None, False
-    normalized = _normalize_date(text)
-    if normalized:
-        parsed = _parse_date_str(normalized)
-        return parsed, True
-
     lowered = text.lower()
+    if _DATE_HINT_RE.search(lowered) is None:
+        return None, False
+    match = None
+    for candidate in _QUERY_DATE_RE.finditer(lowered):
+        if match is None or (
+            _DATE_PRIORITY[candidate.lastgroup] < _DATE_PRIORITY[match.lastgroup]
+        ):
+            match = candidate
+    if match is None:
+        return None, False
+
+    kind = match.lastgroup
     today = date.today()
-    if "day after tomorrow" in lowered:
+    if kind == "iso":
+        try:
+            return (
+                date(
+                    int(match.group("iso_year")),
+                    int(match.group("iso_month")),
+                    int(match.group("iso_day")),
+                ),
+                True,
+            )
+        except ValueError:
+            return None, True
+    if kind == "day_after_tomorrow":
         return today + timedelta(days=2), False
-    if "tomorrow" in lowered:
+    if kind == "tomorrow":
         return today + timedelta(days=1), False
-    if "today" in lowered:
+    if kind == "today":
         return today, False
 
-    match = _MONTH_DAY_RE.search(lowered) or _MONTH_DAY_RE_REV.search(lowered)
-    if match:
-        day = int(match.group("day"))
-        month_token = match.group("month")
-        month = _MONTHS.get(month_token[:3], _MONTHS.get(month_token, 0))
-        year_text = match.group("year")
+    if kind in ("day_month", "month_day"):
+        prefix = "dm_" if kind == "day_month" else "md_"
+        day = int(match.group(prefix + "day"))
+        month_token = match.group(prefix + "month")
+        # _MONTHS has every spelling _MONTH_PATTERN can capture.
+        month = _MONTHS[month_token]
+        year_text = match.group(prefix + "year")
         year = int(year_text) if year_text else today.year
         try:
             return date(year, month, day), bool(year_text)
         except ValueError:
             return None, False
 
-    match = _WEEKDAY_RE.search(lowered)
-    if match:
-        qualifier = match.group("qualifier")
-        weekday = _WEEKDAYS[match.group("weekday")]
-        days_ahead = (weekday - today.weekday()) % 7
-        if qualifier == "next" and days_ahead == 0:
-            days_ahead = 7
-        return today + timedelta(days=days_ahead), False
-
-    return None, False
+    qualifier = match.group("qualifier")
+    weekday = _WEEKDAYS[match.group("weekday_name")]
+    days_ahead = (weekday - today.weekday()) % 7
+    if qualifier == "next" and days_ahead == 0:
+        days_ahead = 7
+    return today + timedelta(days=days_ahead), False
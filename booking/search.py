@@ -1,61 +1,101 @@
-import json
-import math
 import os
+import threading
 
+import numpy as np
+import orjson
 from openai import OpenAIError
 
-from .embeddings import EMBED_MODEL, _embed_query_cached
-from .index import _default_db_path, _ensure_index, _get_conn
-from .parsing import _parse_date_str, _query_tokens, _resolve_query_date, _tokenize
+from .embeddings import EMBED_MODEL, _default_db_path, _embed_query_cached
+from .index import (
+    _embeddings_path,
+    _ensure_index,
+    _get_conn,
+    _has_vec_table,
+    _load_embedding_file,
+    _load_vec,
+    _normalize_vectors,
+    _pack_embedding,
+)
+from .loader import get_table
+from .parsing import (
+    _is_available,
+    _normalize_room_type,
+    _query_tokens,
+    _resolve_query_date,
+    _tokenize,
+)
 
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+_index_build_lock = threading.Lock()
+_QUANTIZE_EMBEDDINGS = os.environ.get("BOOKING_QUANTIZE_EMBEDDINGS") == "1"
+# Score the whole matrix once candidates make up at least 1/4 of the rows.
+_FULL_SCAN_FRACTION = 4
 
-def _normalize_status(value):
-    return (value or "").strip().lower()
 
+def _detect_room_type(tokens, catalog):
+    query_tokens = frozenset(tokens)
+    if not query_tokens:
+        return None
+    for tokens, original in catalog:
+        if tokens <= query_tokens:
+            return original
+    return None
 
-def _normalize_room_type(value):
-    return " ".join(_tokenize(value or "")).strip()
 
+def _filter_positions(index, positions, availability_only, room_type_filter=None):
+    positions = np.asarray(positions, dtype=np.intp)
+    keep = np.ones(len(positions), dtype=bool)
+    if availability_only:
+        keep &= index["available"][positions]
+    normalized_filter = _normalize_room_type(room_type_filter) if room_type_filter else ""
+    if normalized_filter:
+        keep &= index["room_types"][positions] == normalized_filter
+    return positions[keep].tolist()
 
-def _detect_room_type(query, rows):
-    query_tokens = set(_tokenize(query))
-    if not query_tokens:
-        return None
-    room_types = {}
-    for row in rows:
-        room_type = row.get("room_type") or ""
-        normalized = _normalize_room_type(room_type)
-        if normalized:
-            room_types.setdefault(normalized, room_type)
-    candidates = []
-    for normalized, original in room_types.items():
-        tokens = normalized.split()
-        if tokens and set(tokens).issubset(query_tokens):
-            candidates.append((len(tokens), len(normalized), original, normalized))
-    if not candidates:
-        return None
-    candidates.sort(reverse=True)
-    return candidates[0][2]
 
+def _quantize_vectors(vectors):
+    # Symmetric per-row int8: each row keeps its own scale, so the matrix is
+    # a quarter of the float32 size and scores stay in the same order for
+    # all but near-ties.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=-1) / 127
+    scales[scales == 0] = 1
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
 
-def _is_available(row):
-    status = _normalize_status(row.get("status"))
-    return status in {"available", "vacant"} or status.startswith("available")
 
+def _score_positions(index, positions, query_embedding):
+    query = _normalize_vectors(query_embedding)
+    scales = index["scales"]
+    if scales is None:
+        # Gathering the candidate rows copies them, which only costs more than
+        # scoring the whole contiguous matrix once the prefilter keeps a large
+        # share of it.
+        if len(positions) * _FULL_SCAN_FRACTION >= len(index["embeddings"]):
+            return (index["embeddings"] @ query)[positions]
+        return index["embeddings"][positions] @ query
+    # int8 rows are only widened for the candidates being scored.
+    return (index["embeddings"][positions].astype(np.float32) @ query) * scales[positions]
 
-def _filter_rows(rows, availability_only, room_type_filter=None):
-    filtered = rows
-    if availability_only:
-        filtered = [row for row in filtered if _is_available(row)]
-    if room_type_filter:
-        normalized_filter = _normalize_room_type(room_type_filter)
-        if normalized_filter:
-            filtered = [
-                row
-                for row in filtered
-                if _normalize_room_type(row.get("room_type")) == normalized_filter
-            ]
-    return filtered
+
+def _top_positions(index, positions, query_embedding, limit):
+    # Only the best `limit` rows are returned, so partition them out in O(n)
+    # and sort just those instead of ranking every candidate.
+    if limit <= 0 or not positions:
+        return []
+    positions = np.asarray(positions, dtype=np.intp)
+    negated = -_score_positions(index, positions, query_embedding)
+    if limit < len(positions):
+        # Keep every candidate tied with the cut-off score; argpartition
+        # alone would pick among them arbitrarily.
+        cutoff = np.partition(negated, limit - 1)[limit - 1]
+        top = np.flatnonzero(negated <= cutoff)
+    else:
+        top = np.arange(len(positions))
+    # Ties go to the earlier row, as a full stable sort would order them.
+    order = np.lexsort((top, negated[top]))[:limit]
+    return positions[top[order]].tolist()
 
 
 def _sort_room_number(value):
@@ -99,34 +139,212 @@ def _summarize_rows(
     }
 
 
-def _cosine_similarity(vec_a, vec_b):
-    dot = sum(a * b for a, b in zip(vec_a, vec_b))
-    norm_a = math.sqrt(sum(a * a for a in vec_a))
-    norm_b = math.sqrt(sum(b * b for b in vec_b))
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    return dot / (norm_a * norm_b)
+_FETCH_SIZE = 1024
 
 
-def _load_index_rows(conn, csv_path):
-    rows = conn.execute(
+def _load_index_rows(conn, csv_path, embeddings_path):
+    # Columns are streamed as plain tuples in chunks and kept as parallel
+    # lists, which avoids a sqlite3.Row and a dict per row.
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(
         """
-        SELECT row_json, row_text, embedding_json
+        SELECT row_index, row_json, row_text
         FROM booking_vectors
         WHERE csv_path = ?
+        ORDER BY row_index
         """,
         (csv_path,),
-    ).fetchall()
-    return [
-        {
-            "row": json.loads(row["row_json"]),
-            "row_text": row["row_text"],
-            "embedding": json.loads(row["embedding_json"]),
-            "tokens": set(_tokenize(row["row_text"])),
-            "row_date": _parse_date_str(json.loads(row["row_json"]).get("date", "")),
-        }
-        for row in rows
-    ]
+    )
+    row_indexes, rows, row_texts = [], [], []
+    while True:
+        chunk = cursor.fetchmany(_FETCH_SIZE)
+        if not chunk:
+            break
+        for row_index, row_json, row_text in chunk:
+            row_indexes.append(row_index)
+            rows.append(orjson.loads(row_json))
+            row_texts.append(row_text)
+    columns = {"row_indexes": row_indexes, "rows": rows, "row_texts": row_texts}
+    if not rows:
+        return columns, np.empty((0, 0), dtype=np.float32)
+    embeddings = _load_embedding_file(conn, embeddings_path, csv_path, len(rows))
+    if embeddings is not None:
+        return columns, embeddings
+    # Without the memory-mapped file, decode the packed float32 blobs in one
+    # pass and unit-normalize them so cosine similarity against every
+    # candidate is a single matrix-vector product.
+    cursor.execute(
+        "SELECT embedding FROM booking_vectors WHERE csv_path = ? ORDER BY row_index",
+        (csv_path,),
+    )
+    embeddings = np.frombuffer(
+        b"".join(blob for (blob,) in cursor), dtype=np.float32
+    ).reshape(len(rows), -1)
+    return columns, _normalize_vectors(embeddings)
+
+
+def _get_index(csv_path, db_path):
+    # The parsed index lives in process memory until the CSV or the embedding
+    # model changes, so warm queries skip SQLite and JSON decoding entirely.
+    try:
+        mtime = os.stat(csv_path).st_mtime_ns
+    except OSError:
+        return None
+    key = (csv_path, db_path)
+    index = _cached_index(key, mtime)
+    if index is not None:
+        return index
+    # Concurrent cold queries wait for a single load instead of each parsing
+    # the whole index (and possibly re-embedding it) on their own.
+    with _index_build_lock:
+        index = _cached_index(key, mtime)
+        if index is not None:
+            return index
+        return _load_index(csv_path, db_path, key, mtime)
+
+
+def _cached_index(key, mtime):
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+    if index is not None and index["mtime"] == mtime and index["model"] == EMBED_MODEL:
+        return index
+    return None
+
+
+def _load_index(csv_path, db_path, key, mtime):
+    current = _ensure_index(csv_path, db_path)
+    conn = _get_conn(db_path)
+    try:
+        use_vec = _load_vec(conn) and _has_vec_table(conn)
+        columns, embeddings = _load_index_rows(conn, csv_path, _embeddings_path(db_path))
+    finally:
+        conn.close()
+    rows = columns["rows"]
+    if not rows:
+        return None
+    # Token -> row positions, so keyword prefiltering only touches the rows
+    # that share a token with the query. Built with the same _tokenize as the
+    # query tokens, once per load.
+    postings = {}
+    for position, row_text in enumerate(columns["row_texts"]):
+        for token in set(_tokenize(row_text)):
+            postings.setdefault(token, []).append(position)
+    scales = None
+    if _QUANTIZE_EMBEDDINGS:
+        embeddings, scales = _quantize_vectors(embeddings)
+    index = {
+        "mtime": mtime,
+        "model": EMBED_MODEL,
+        "rows": rows,
+        "embeddings": embeddings,
+        "scales": scales,
+        "positions": {
+            row_index: position for position, row_index in enumerate(columns["row_indexes"])
+        },
+        "postings": postings,
+        # Status and room type never change for a loaded index, so they are
+        # normalized once here rather than on every filtered query.
+        "available": np.array([_is_available(row) for row in rows], dtype=bool),
+        "room_types": np.array(
+            [_normalize_room_type(row.get("room_type")) for row in rows],
+            dtype=str,
+        ),
+        "use_vec": use_vec,
+        "current": current,
+    }
+    # A failed rebuild leaves the previous CSV's rows behind; serve them for
+    # this query but keep them out of the cache so the next one retries.
+    if current:
+        with _index_cache_lock:
+            _index_cache[key] = index
+    return index
+
+
+# sqlite-vec caps k for a single KNN query.
+_VEC_MAX_K = 4096
+
+
+def _nearest_row_indexes(
+    db_path,
+    csv_path,
+    query_embedding,
+    availability_only=False,
+    room_type_filter=None,
+):
+    # Status and room-type filters are vec0 metadata columns, so sqlite-vec
+    # applies them inside the KNN scan and only matching rows come back.
+    sql = """
+        SELECT row_index
+        FROM booking_vec
+        WHERE embedding MATCH ? AND k = ? AND csv_path = ?
+    """
+    params = [_pack_embedding(query_embedding), _VEC_MAX_K, csv_path]
+    if availability_only:
+        sql += " AND available = 1"
+    normalized_filter = _normalize_room_type(room_type_filter) if room_type_filter else ""
+    if normalized_filter:
+        sql += " AND room_type = ?"
+        params.append(normalized_filter)
+    conn = _get_conn(db_path)
+    try:
+        if not _load_vec(conn):
+            return None
+        rows = conn.execute(sql + " ORDER BY distance", params).fetchall()
+    finally:
+        conn.close()
+    return [row["row_index"] for row in rows]
+
+
+def _match_tokens(index, query_tokens):
+    postings = index["postings"]
+    matched = set()
+    for token in query_tokens:
+        matched.update(postings.get(token, ()))
+    if matched:
+        return sorted(matched)
+    return list(range(len(index["rows"])))
+
+
+def _rank_by_overlap(index, positions, query_tokens):
+    postings = index["postings"]
+    overlap = dict.fromkeys(positions, 0)
+    for token in query_tokens:
+        for position in postings.get(token, ()):
+            if position in overlap:
+                overlap[position] += 1
+    # sorted() is stable, so rows with equal overlap keep CSV order.
+    return sorted(positions, key=lambda position: -overlap[position])
+
+
+def _rows_for_date(
+    table,
+    query_date,
+    is_explicit_year,
+    availability_only=False,
+    room_type_filter=None,
+):
+    month_day = query_date.month * 100 + query_date.day
+    key = query_date.year * 10000 + month_day
+    start, end = np.searchsorted(table["sorted_dates"], [key, key + 1])
+    indices = table["date_order"][start:end]
+    if not len(indices) and not is_explicit_year:
+        indices = np.flatnonzero(table["dates"] % 10000 == month_day)
+        indices = indices[np.argsort(table["room_numbers"][indices], kind="stable")]
+    if not len(indices):
+        return None
+    keep = np.ones(len(indices), dtype=bool)
+    if availability_only:
+        keep &= table["available"][indices]
+    if room_type_filter:
+        normalized_filter = _normalize_room_type(room_type_filter)
+        if normalized_filter:
+            keep &= table["room_types"][indices] == normalized_filter
+    return [table["rows"][index] for index in indices[keep]]
+
+
+def _result(rows, summary, include_summary):
+    return (rows, summary) if include_summary else rows
 
 
 def find_relevant_rows(
@@ -139,94 +357,96 @@ def find_relevant_rows(
 ):
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
-        return ([], None) if include_summary else []
+        return _result([], None, include_summary)
 
-    db_path = db_path or _default_db_path()
-    _ensure_index(csv_path, db_path)
+    table = get_table(csv_path)
+    query_text = query.strip()
+    if not table or not table["rows"] or not query_text:
+        return _result([], None, include_summary)
 
-    conn = _get_conn(db_path)
     try:
-        rows = _load_index_rows(conn, os.path.abspath(csv_path))
-    finally:
-        conn.close()
+        query_date, is_explicit_year = _resolve_query_date(query_text)
+    except ValueError:
+        return _result([], None, include_summary)
+    # The query is tokenized once for room-type detection and, below, the
+    # keyword prefilter.
+    tokens = _tokenize(query_text)
+    room_type_filter = _detect_room_type(tokens, table["room_type_catalog"])
+    if query_date:
+        # Dated questions are answered straight from the preloaded CSV
+        # columns; only free-form questions need the embedding index.
+        filtered_rows = _rows_for_date(
+            table,
+            query_date,
+            is_explicit_year,
+            availability_only=availability_only,
+            room_type_filter=room_type_filter,
+        )
+        if filtered_rows is not None:
+            summary = _summarize_rows(
+                filtered_rows,
+                query_date=query_date,
+                is_explicit_year=is_explicit_year,
+                availability_only=availability_only,
+                room_type_filter=room_type_filter,
+                summary_complete=True,
+            )
+            limited_rows = filtered_rows[:max_rows]
+            return _result(limited_rows, summary, include_summary)
 
-    if not rows:
-        return ([], None) if include_summary else []
+    db_path = db_path or _default_db_path()
+    index_path = os.path.abspath(csv_path)
+    index = _get_index(index_path, db_path)
+    if not index:
+        return _result([], None, include_summary)
 
-    try:
-        query_text = query.strip()
-        if not query_text:
-            return ([], None) if include_summary else []
-        query_date, is_explicit_year = _resolve_query_date(query_text)
-        room_type_filter = _detect_room_type(query_text, [item["row"] for item in rows])
-        if query_date:
-            date_rows = [item for item in rows if item["row_date"] == query_date]
-            if date_rows:
-                date_rows.sort(key=lambda item: item["row"].get("room_number", ""))
-                all_rows = [item["row"] for item in date_rows]
-                filtered_rows = _filter_rows(
-                    all_rows, availability_only, room_type_filter=room_type_filter
-                )
-                summary = _summarize_rows(
-                    filtered_rows,
-                    query_date=query_date,
-                    is_explicit_year=is_explicit_year,
-                    availability_only=availability_only,
-                    room_type_filter=room_type_filter,
-                    summary_complete=True,
-                )
-                limited_rows = filtered_rows[:max_rows]
-                return (limited_rows, summary) if include_summary else limited_rows
-            if not is_explicit_year:
-                month_day_rows = [
-                    item
-                    for item in rows
-                    if item["row_date"]
-                    and item["row_date"].month == query_date.month
-                    and item["row_date"].day == query_date.day
-                ]
-                if month_day_rows:
-                    month_day_rows.sort(
-                        key=lambda item: item["row"].get("room_number", "")
-                    )
-                    all_rows = [item["row"] for item in month_day_rows]
-                    filtered_rows = _filter_rows(
-                        all_rows, availability_only, room_type_filter=room_type_filter
-                    )
-                    summary = _summarize_rows(
-                        filtered_rows,
-                        query_date=query_date,
-                        is_explicit_year=False,
-                        availability_only=availability_only,
-                        room_type_filter=room_type_filter,
-                        summary_complete=True,
-                    )
-                    limited_rows = filtered_rows[:max_rows]
-                    return (limited_rows, summary) if include_summary else limited_rows
-        query_tokens = _query_tokens(query_text)
-        candidates = rows
-        if query_tokens:
-            filtered = [item for item in rows if item["tokens"] & query_tokens]
-            if filtered:
-                candidates = filtered
-        query_embedding = _embed_query_cached(EMBED_MODEL, query_text)
-    except (OpenAIError, ValueError):
-        return ([], None) if include_summary else []
-
-    scored = []
-    for item in candidates:
-        score = _cosine_similarity(query_embedding, item["embedding"])
-        scored.append((score, item["row"]))
-
-    scored.sort(key=lambda item: item[0], reverse=True)
-    all_rows = [item[1] for item in scored]
-    filtered_rows = _filter_rows(
-        all_rows, availability_only, room_type_filter=room_type_filter
+    rows = index["rows"]
+    query_tokens = _query_tokens(tokens)
+    positions = _match_tokens(index, query_tokens)
+    # Status and room-type filters do not depend on the score, so they run
+    # before ranking and only the rows that survive are scored.
+    filtered_positions = _filter_positions(
+        index, positions, availability_only, room_type_filter=room_type_filter
     )
-    limited_rows = filtered_rows[:max_rows]
+    if len(filtered_positions) <= max_rows:
+        # Every candidate is returned either way, so the embedding would only
+        # reorder them; rank by keyword overlap and skip the API round-trip.
+        top_positions = _rank_by_overlap(index, filtered_positions, query_tokens)
+    else:
+        try:
+            query_embedding = _embed_query_cached(EMBED_MODEL, query_text, db_path)
+        except (OpenAIError, ValueError):
+            return _result([], None, include_summary)
+        nearest = None
+        if index["use_vec"]:
+            nearest = _nearest_row_indexes(
+                db_path,
+                index_path,
+                query_embedding,
+                availability_only=availability_only,
+                room_type_filter=room_type_filter,
+            )
+        ranked = None
+        if nearest is not None:
+            matched = set(filtered_positions)
+            ranked = [
+                index["positions"][row_index]
+                for row_index in nearest
+                if index["positions"].get(row_index) in matched
+            ]
+        # The KNN scan is capped at _VEC_MAX_K rows and may be missing rows
+        # from another build, so its order is only used when it ranked every
+        # candidate; otherwise the candidates are scored here.
+        if ranked is not None and len(ranked) == len(filtered_positions):
+            top_positions = ranked[:max_rows]
+        else:
+            top_positions = _top_positions(
+                index, filtered_positions, query_embedding, max_rows
+            )
+    limited_rows = [rows[position] for position in top_positions]
     summary = (
         _summarize_rows(
-            filtered_rows,
+            [rows[position] for position in filtered_positions],
             availability_only=availability_only,
             room_type_filter=room_type_filter,
             summary_complete=False,
@@ -234,4 +454,6 @@ def find_relevant_rows(
         if include_summary
         else None
     )
-    return (limited_rows, summary) if include_summary else limited_rows
+    if summary is not None:
+        summary["index_current"] = index["current"]
+    return _result(limited_rows, summary, include_summary)